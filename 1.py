@@ -1,15 +1,16 @@
 import os
 import re
+import hashlib
+import functools
 import asyncio
-import requests
-from urllib.parse import urlparse
+import httpx
+import tiktoken
+from diskcache import Cache
 from dotenv import load_dotenv
-from fastmcp import FastMCP
+from fastmcp import FastMCP, Context
 from firecrawl import AsyncFirecrawlApp
 from langchain.prompts import PromptTemplate
 from langchain.schema.output_parser import StrOutputParser
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationChain
 from langchain_nvidia_ai_endpoints import ChatNVIDIA
 from youtube_transcript_api import YouTubeTranscriptApi
 import yt_dlp
@@ -17,122 +18,333 @@ import yt_dlp
 # Load environment variables
 load_dotenv()
 
+# API keys are required; a missing key fails at import rather than on first use
+NVIDIA_API_KEY = os.environ["NVIDIA_API_KEY"]
+FIRECRAWL_API_KEY = os.environ["FIRECRAWL_API_KEY"]
+SCRAPINGDOG_API_KEY = os.environ["SCRAPINGDOG_API_KEY"]
+
+# Upstream concurrency limits
+_FIRECRAWL_SEM = asyncio.Semaphore(int(os.getenv("FIRECRAWL_CONCURRENCY", "8")))
+_NVIDIA_SEM = asyncio.Semaphore(int(os.getenv("NVIDIA_CONCURRENCY", "16")))
+
+# Shared HTTP/2 client with connection pooling for outbound API calls
+HTTPX = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+
 # MCP setup
 mcp = FastMCP("market_intelligence_agent")
 
-# ========== Website Tool ==========
+# ========== Shared LLM + Prompts ==========
 
-async def scrape_website_with_firecrawl(api_key: str, url: str, formats=['markdown'], only_main_content=True):
-    app = AsyncFirecrawlApp(api_key=api_key)
-    response = await app.scrape_url(url=url, formats=formats, only_main_content=only_main_content)
-    return response
+LLM = ChatNVIDIA(
+    model="meta/llama3-70b-instruct",
+    nvidia_api_key=NVIDIA_API_KEY,
+    temperature=0.3
+)
 
-@mcp.tool
-async def analyze_website(url: str, question: str) -> str:
-    context = await scrape_website_with_firecrawl(
-        api_key=os.getenv("FIRECRAWL_API_KEY"),
-        url=url
-    )
+WEBSITE_PROMPT = PromptTemplate(
+    template="""
+    You are an experienced market analyst. Based on the content of the website below, answer the following question.
 
-    llm = ChatNVIDIA(
-        model="meta/llama3-70b-instruct",
-        nvidia_api_key=os.getenv("NVIDIA_API_KEY"),
-        temperature=0.3
-    )
+    Website Content:
+    {context}
 
-    prompt = PromptTemplate(
-        template="""
-        You are an experienced market analyst. Based on the content of the website below, answer the following question.
+    Question: {question}
+    """,
+    input_variables=["context", "question"]
+)
 
-        Website Content:
-        {context}
+STRUCTURED_PROMPT = PromptTemplate(
+    template="""
+    You are a data processing agent. Your task is to process the following input data and return a well-formatted, structured response in markdown format.
+    
+    Input Data:
+    {input_data}
+    
+    Please analyze the content and structure your response with appropriate sections, headings, bullet points, and summaries.
+    """,
+    input_variables=["input_data"]
+)
 
-        Question: {question}
-        """,
-        input_variables=["context", "question"]
-    )
+YT_PROMPT = PromptTemplate(
+    template="""
+    This is the transcript of a YouTube video:
+
+    Transcript:
+    {transcript}
+
+    Question: {question}
+    Answer:
+    """,
+    input_variables=["transcript", "question"]
+)
+
+# Fused prompts: answer and format in markdown in a single LLM call
+WEBSITE_STRUCTURED_PROMPT = PromptTemplate(
+    template="""
+    You are an experienced market analyst. Based on the content of the website below, answer the following question.
+
+    Website Content:
+    {context}
+
+    Question: {question}
+
+    Return your answer as a well-formatted, structured response in markdown format, with appropriate sections, headings, bullet points, and summaries.
+    """,
+    input_variables=["context", "question"]
+)
+
+YT_STRUCTURED_PROMPT = PromptTemplate(
+    template="""
+    This is the transcript of a YouTube video:
+
+    Transcript:
+    {transcript}
+
+    Question: {question}
 
-    chain = prompt | llm | StrOutputParser()
-    return await chain.ainvoke({"context": context, "question": question})
+    Return your answer as a well-formatted, structured response in markdown format, with appropriate sections, headings, bullet points, and summaries.
+    """,
+    input_variables=["transcript", "question"]
+)
+
+WEBSITE_CHAIN = WEBSITE_PROMPT | LLM | StrOutputParser()
+YT_CHAIN = YT_PROMPT | LLM | StrOutputParser()
+STRUCTURED_CHAIN = STRUCTURED_PROMPT | LLM | StrOutputParser()
+WEBSITE_STRUCTURED_CHAIN = WEBSITE_STRUCTURED_PROMPT | LLM | StrOutputParser()
+YT_STRUCTURED_CHAIN = YT_STRUCTURED_PROMPT | LLM | StrOutputParser()
+
+# ========== Context Size Limits ==========
+
+# llama3-70b has an 8k context window; cl100k_base is a close enough approximation of its tokenizer
+@functools.cache
+def get_encoding():
+    # Loaded on first use rather than at import: on a fresh host tiktoken downloads the BPE file
+    return tiktoken.get_encoding("cl100k_base")
+
+MAX_CONTEXT_TOKENS = 6000
+CHUNK_TOKENS = 4000
+CHUNK_OVERLAP = 200
+MAX_CHUNKS = 6
+
+def truncate_head_tail(text: str, max_tokens: int = MAX_CONTEXT_TOKENS) -> str:
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    half = max_tokens // 2
+    return encoding.decode(tokens[:half]) + "\n...\n" + encoding.decode(tokens[-half:])
+
+def split_into_chunks(tokens: list[int]) -> list[str]:
+    step = CHUNK_TOKENS - CHUNK_OVERLAP
+    # Stop before a trailing chunk that would lie entirely inside the previous chunk's overlap
+    starts = range(0, max(len(tokens) - CHUNK_OVERLAP, 1), step)
+    return [get_encoding().decode(tokens[i:i + CHUNK_TOKENS]) for i in starts]
+
+def chunk_oversized_context(context: str) -> list[str] | None:
+    # CPU-bound for large pages, so callers run it in a worker thread
+    tokens = get_encoding().encode(context)
+    if len(tokens) <= MAX_CONTEXT_TOKENS:
+        return None
+    # Cap the fan-out by keeping the head and tail of very large pages
+    max_tokens = MAX_CHUNKS * (CHUNK_TOKENS - CHUNK_OVERLAP) + CHUNK_OVERLAP
+    if len(tokens) > max_tokens:
+        half = max_tokens // 2
+        tokens = tokens[:half] + tokens[-half:]
+    return split_into_chunks(tokens)
+
+async def invoke_chain(chain, inputs: dict) -> str:
+    async with _NVIDIA_SEM:
+        return await chain.ainvoke(inputs)
+
+async def stream_chain(chain, inputs: dict, ctx: Context) -> str:
+    # Each token chunk is sent to the client as a progress message as soon as it arrives
+    chunks = []
+    async with _NVIDIA_SEM:
+        async for chunk in chain.astream(inputs):
+            chunks.append(chunk)
+            await ctx.report_progress(len(chunks), message=chunk)
+    return "".join(chunks)
+
+# ========== Website Tool ==========
+
+FIRECRAWL = AsyncFirecrawlApp(api_key=FIRECRAWL_API_KEY)
+_SCRAPE_CACHE = Cache(".cache/scrapes")
+_SCRAPE_TTL = 6 * 60 * 60
+
+async def scrape_website_with_firecrawl(url: str, formats=['markdown'], only_main_content=True) -> str:
+    async with _FIRECRAWL_SEM:
+        response = await FIRECRAWL.scrape_url(url=url, formats=formats, only_main_content=only_main_content)
+    # Only the page markdown goes into the prompt, not the HTML and metadata of the full response
+    return response.markdown or ""
+
+async def get_website_context(url: str) -> str:
+    key = hashlib.sha1(url.encode()).hexdigest()
+    # diskcache is synchronous SQLite, so keep it off the event loop
+    context = await asyncio.to_thread(_SCRAPE_CACHE.get, key)
+    if context is None:
+        context = await scrape_website_with_firecrawl(url=url)
+        # Empty scrapes are not cached, so the next question retries the scrape
+        if context:
+            await asyncio.to_thread(_SCRAPE_CACHE.set, key, context, expire=_SCRAPE_TTL)
+    return context
+
+async def condense_website_context(context: str, question: str) -> str:
+    # Oversized pages are answered chunk by chunk; the partial answers become the context for the final call
+    chunks = await asyncio.to_thread(chunk_oversized_context, context)
+    if chunks is None:
+        return context
+    partials = await asyncio.gather(*(
+        invoke_chain(WEBSITE_CHAIN, {"context": chunk, "question": question})
+        for chunk in chunks
+    ))
+    notes = "\n\n".join(f"Notes from part {i}:\n{p}" for i, p in enumerate(partials, 1))
+    # The combined notes must still fit the final call
+    return await asyncio.to_thread(truncate_head_tail, notes)
+
+@mcp.tool
+async def analyze_website(url: str, question: str, structured: bool = False) -> str:
+    context = await get_website_context(url)
+    if not context:
+        return "[!] No content could be scraped from the website."
+    context = await condense_website_context(context, question)
+    chain = WEBSITE_STRUCTURED_CHAIN if structured else WEBSITE_CHAIN
+    return await invoke_chain(chain, {"context": context, "question": question})
+
+@mcp.tool
+async def analyze_website_stream(url: str, question: str, ctx: Context, structured: bool = False) -> str:
+    """
+    Streaming version of analyze_website: tokens are sent as progress messages.
+    """
+    context = await get_website_context(url)
+    if not context:
+        return "[!] No content could be scraped from the website."
+    context = await condense_website_context(context, question)
+    chain = WEBSITE_STRUCTURED_CHAIN if structured else WEBSITE_CHAIN
+    return await stream_chain(chain, {"context": context, "question": question}, ctx)
 
 # ========== YouTube Tool ==========
 
-def scrap_videos(query: str, max_results: int = 1):
-    ydl_opts = {
-        'format': 'best',
-        'noplaylist': True,
-        'quiet': True,
-        'default_search': 'ytsearch',
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        search_results = ydl.extract_info(query, download=False)
-        entries = search_results.get('entries', [search_results])
-        videos = entries[:max_results]
-        return [{
-            "title": video["title"],
-            "url": f"https://www.youtube.com/watch?v={video['id']}",
-            "video_id": video["id"]
-        } for video in videos]
+_VIDEO_ID_RE = re.compile(r"(?:v=|/)([0-9A-Za-z_-]{11})")
+_TRANSCRIPT_CACHE = Cache(".cache/transcripts")
+_TRANSCRIPT_TTL = 7 * 24 * 60 * 60
+
+# Creating a YoutubeDL loads all extractors, so a small pool of instances is reused.
+# YoutubeDL is not thread-safe, so each search checks one out for its worker thread.
+_YDL_SEARCH_OPTS = {
+    'format': 'best',
+    'noplaylist': True,
+    'quiet': True,
+    'default_search': 'ytsearch',
+}
+_YDL_POOL_SIZE = 4
+_YDL_POOL = asyncio.Queue()
+for _ in range(_YDL_POOL_SIZE):
+    _YDL_POOL.put_nowait(yt_dlp.YoutubeDL(_YDL_SEARCH_OPTS))
+
+def scrap_videos(ydl: yt_dlp.YoutubeDL, query: str, max_results: int = 1):
+    search_results = ydl.extract_info(query, download=False)
+    entries = search_results.get('entries', [search_results])
+    videos = entries[:max_results]
+    return [{
+        "title": video["title"],
+        "url": f"https://www.youtube.com/watch?v={video['id']}",
+        "video_id": video["id"]
+    } for video in videos]
+
+async def search_videos(query: str):
+    # Waiting for a free instance happens on the event loop, not in an executor thread
+    ydl = await _YDL_POOL.get()
+    try:
+        return await asyncio.to_thread(scrap_videos, ydl, query)
+    finally:
+        _YDL_POOL.put_nowait(ydl)
 
 def extract_video_id(url: str) -> str:
-    match = re.search(r"(?:v=|\/)([0-9A-Za-z_-]{11})", url)
+    match = _VIDEO_ID_RE.search(url)
     return match.group(1) if match else None
 
 def get_transcript_text(video_id: str) -> str:
+    cached = _TRANSCRIPT_CACHE.get(video_id)
+    if cached is not None:
+        return cached
     try:
-        transcript = YouTubeTranscriptApi.get_transcript(video_id)
-        return "\n".join([t.get("text", "") for t in transcript]).strip()
+        transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=["en"], preserve_formatting=False)
+        text = " ".join(t["text"] for t in transcript if t.get("text")).strip()
     except Exception as e:
         return f"[!] Transcript not available.\nReason: {e}"
+    _TRANSCRIPT_CACHE.set(video_id, text, expire=_TRANSCRIPT_TTL)
+    return text
 
-async def get_llm_chain(transcript: str):
-    llm = ChatNVIDIA(
-        model="meta/llama3-70b-instruct",
-        nvidia_api_key=os.getenv("NVIDIA_API_KEY"),
-        temperature=0.3
-    )
-    memory = ConversationBufferMemory(return_messages=True)
-    chain = ConversationChain(llm=llm, memory=memory, verbose=False)
-    await chain.apredict(input=f"This is the transcript of a YouTube video:\n\n{transcript}\n\nNow I'll ask you questions about it.")
-    return chain
+def get_truncated_transcript(video_id: str) -> str:
+    # Keep the start and end of long transcripts so the prompt fits the model's context window.
+    # Tokenizing is CPU-bound, so this runs in the same worker thread as the fetch.
+    return truncate_head_tail(get_transcript_text(video_id))
 
-@mcp.tool
-async def ask_youtube_question(video_url_or_query: str, question: str) -> str:
+async def get_video_transcript(video_url_or_query: str) -> str:
     if video_url_or_query.startswith("http"):
         video_id = extract_video_id(video_url_or_query)
         if not video_id:
             return "[!] Could not extract video ID from URL."
         video = {"video_id": video_id, "url": video_url_or_query, "title": "YouTube_Transcript"}
     else:
-        videos = scrap_videos(video_url_or_query)
+        videos = await search_videos(video_url_or_query)
         if not videos:
             return "[!] No video found."
         video = videos[0]
 
-    transcript = get_transcript_text(video["video_id"])
+    return await asyncio.to_thread(get_truncated_transcript, video["video_id"])
+
+@mcp.tool
+async def ask_youtube_question(video_url_or_query: str, question: str, structured: bool = False) -> str:
+    transcript = await get_video_transcript(video_url_or_query)
     if transcript.startswith("[!]"):
         return transcript
 
-    chain = await get_llm_chain(transcript)
-    return await chain.apredict(input=question)
+    chain = YT_STRUCTURED_CHAIN if structured else YT_CHAIN
+    return await invoke_chain(chain, {"transcript": transcript, "question": question})
+
+@mcp.tool
+async def ask_youtube_question_stream(video_url_or_query: str, question: str, ctx: Context, structured: bool = False) -> str:
+    """
+    Streaming version of ask_youtube_question: tokens are sent as progress messages.
+    """
+    transcript = await get_video_transcript(video_url_or_query)
+    if transcript.startswith("[!]"):
+        return transcript
+
+    chain = YT_STRUCTURED_CHAIN if structured else YT_CHAIN
+    return await stream_chain(chain, {"transcript": transcript, "question": question}, ctx)
 
 # ========== LinkedIn Tool ==========
 
-@mcp.tool
-async def analyze_linkedin(linkedin_link: str) -> str:
-    scrapingdog_api_key = os.getenv("SCRAPINGDOG_API_KEY")
-    
-    if not scrapingdog_api_key:
-        return "API key not found. Please check your .env file."
+_LINKEDIN_RE = re.compile(r"linkedin\.com/([^/?#]+)/([^/?#]+)")
+
+# Fields kept from the Scrapingdog response; the rest only inflates the prompt downstream
+_LINKEDIN_FIELDS = {
+    "profile": ("fullName", "headline", "location", "about", "experience", "education"),
+    "company": ("company_name", "tagline", "about", "industry", "company_size", "headquarters", "founded", "specialties", "website"),
+}
 
-    parsed_url = urlparse(linkedin_link)
-    path_parts = parsed_url.path.strip("/").split("/")
+def select_linkedin_fields(data, request_type: str):
+    # Keeps the response shape: a list stays a list and a single record stays a dict
+    if isinstance(data, list):
+        return [select_linkedin_fields(record, request_type) for record in data]
+    if not isinstance(data, dict):
+        return data
+    trimmed = {key: data[key] for key in _LINKEDIN_FIELDS[request_type] if key in data}
+    return trimmed or data
 
-    if len(path_parts) < 2:
+@mcp.tool
+async def analyze_linkedin(linkedin_link: str) -> str:
+    match = _LINKEDIN_RE.search(linkedin_link)
+    if not match:
         return "Invalid LinkedIn URL."
 
-    link_type = path_parts[0]
-    link_id = path_parts[1]
+    link_type, link_id = match.groups()
 
     if link_type == "company":
         request_type = "company"
@@ -143,19 +355,17 @@ async def analyze_linkedin(linkedin_link: str) -> str:
     else:
         return "Unsupported LinkedIn link type."
 
-    url = "https://api.scrapingdog.com/linkedin"
     params = {
-        "api_key": scrapingdog_api_key,
+        "api_key": SCRAPINGDOG_API_KEY,
         "type": request_type,
         "linkId": link_id,
         "private": is_private
     }
 
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(None, lambda: requests.get(url, params=params))
+    response = await HTTPX.get("https://api.scrapingdog.com/linkedin", params=params)
 
     if response.status_code == 200:
-        data = response.json()
+        data = select_linkedin_fields(response.json(), request_type)
         return f"LinkedIn Data:\n\n{data}"
     else:
         return f"Request failed. Status: {response.status_code}, Message: {response.text}"
@@ -167,30 +377,41 @@ async def structured_tool(input_data: str) -> str:
     This tool processes structured input data and returns a formatted response.
     """
     try:
-        llm = ChatNVIDIA(
-            model="meta/llama3-70b-instruct",
-            nvidia_api_key=os.getenv("NVIDIA_API_KEY"),
-            temperature=0.3
-        )
-        
-        prompt = PromptTemplate(
-            template="""
-            You are a data processing agent. Your task is to process the following input data and return a well-formatted, structured response in markdown format.
-            
-            Input Data:
-            {input_data}
-            
-            Please analyze the content and structure your response with appropriate sections, headings, bullet points, and summaries.
-            """,
-            input_variables=["input_data"]
-        )
-        
-        chain = prompt | llm | StrOutputParser()
-        result = await chain.ainvoke({"input_data": input_data})
-        return result
+        return await invoke_chain(STRUCTURED_CHAIN, {"input_data": input_data})
     except Exception as e:
         return f"Error processing data: {str(e)}"
 
+@mcp.tool
+async def structured_tool_stream(input_data: str, ctx: Context) -> str:
+    """
+    Streaming version of structured_tool: tokens are sent as progress messages.
+    """
+    try:
+        return await stream_chain(STRUCTURED_CHAIN, {"input_data": input_data}, ctx)
+    except Exception as e:
+        return f"Error processing data: {str(e)}"
+
+@mcp.tool
+async def structured_tool_batch(inputs: list[str]) -> list[str]:
+    """
+    Batch version of structured_tool: processes several inputs in one call.
+    """
+    results = await asyncio.gather(
+        *(invoke_chain(STRUCTURED_CHAIN, {"input_data": x}) for x in inputs),
+        return_exceptions=True
+    )
+    return [
+        f"Error processing data: {str(r)}" if isinstance(r, Exception) else r
+        for r in results
+    ]
+
+async def main():
+    try:
+        await mcp.run_async(transport="streamable-http")
+    finally:
+        await HTTPX.aclose()
+
 if __name__ == "__main__":
+    import uvloop
     print("Market Intelligence Agent server starting...")
-    mcp.run(transport="streamable-http")
+    uvloop.run(main())
@@ -1,30 +1,90 @@
 import streamlit as st
 from fastmcp import Client
 import asyncio
+import concurrent.futures
+import queue
+import threading
+import weakref
 
 st.title("📊 Market Intelligence Agent with Structured Output")
-st.markdown("Select a source tool to analyze, then process its output with the Structured Tool.")
+st.markdown("Select a source tool to analyze. Website and YouTube answers are returned already structured; LinkedIn data is processed with the Structured Tool.")
 
-client = Client("https://market-agent-hsp3.onrender.com/mcp")
+@st.cache_resource
+def get_event_loop():
+    # A single background event loop shared by all sessions, so connections outlive script reruns
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
 
-async def call_tool(tool_name: str, params: dict):
-    async with client:
-        result = await client.call_tool(tool_name, params)
-        if isinstance(result, list) and hasattr(result[0], "text"):
-            return result[0].text
-        return result
+loop = get_event_loop()
+
+def run_on_loop(coro):
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+def close_client(client: Client):
+    run_on_loop(client.__aexit__(None, None, None))
+
+class MCPSession:
+    """
+    Holds a connected client and closes it when Streamlit discards the session state.
+    """
+    def __init__(self, client: Client):
+        self.client = client
+        weakref.finalize(self, close_client, client)
+
+# Render cold starts can take close to a minute
+CONNECT_TIMEOUT = 90
+
+def get_client() -> Client:
+    # One connected client per Streamlit session, kept open across reruns. It connects on the
+    # first tool call, inside the caller's try block, and is stored only after connecting
+    # succeeds, so a failed connect shows an error and is retried on the next call.
+    if "mcp_session" not in st.session_state:
+        new_client = Client("https://market-agent-hsp3.onrender.com/mcp")
+        future = run_on_loop(new_client.__aenter__())
+        try:
+            future.result(timeout=CONNECT_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"Could not connect to the MCP server within {CONNECT_TIMEOUT} seconds.")
+        st.session_state.mcp_session = MCPSession(new_client)
+    return st.session_state.mcp_session.client
+
+async def call_tool(client: Client, tool_name: str, params: dict, progress_handler=None):
+    result = await client.call_tool(tool_name, params, progress_handler=progress_handler)
+    # Older fastmcp versions return a list of content items, newer ones a CallToolResult
+    if isinstance(result, list) and hasattr(result[0], "text"):
+        return result[0].text
+    if isinstance(getattr(result, "data", None), str):
+        return result.data
+    content = getattr(result, "content", None)
+    if content and hasattr(content[0], "text"):
+        return content[0].text
+    return result
 
 def call_tool_sync(tool_name: str, params: dict):
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = None
+    return run_on_loop(call_tool(get_client(), tool_name, params)).result()
+
+def stream_tool(tool_name: str, params: dict):
+    # Yields the token chunks a *_stream tool reports as progress messages
+    chunks = queue.Queue()
+    done = object()
+    streamed = []
+
+    async def on_progress(progress, total, message):
+        if message:
+            chunks.put(message)
 
-    if loop and loop.is_running():
-        future = asyncio.run_coroutine_threadsafe(call_tool(tool_name, params), loop)
-        return future.result()
-    else:
-        return asyncio.run(call_tool(tool_name, params))
+    future = run_on_loop(call_tool(get_client(), tool_name, params, progress_handler=on_progress))
+    future.add_done_callback(lambda _: chunks.put(done))
+    while (chunk := chunks.get()) is not done:
+        streamed.append(chunk)
+        yield chunk
+
+    result = future.result()
+    # Errors, including ones raised partway through the stream, come back as the tool result
+    if isinstance(result, str) and result != "".join(streamed):
+        yield f"\n\n{result}" if streamed else result
 
 tool = st.selectbox("Select Source Tool", [
     "Analyze Website",
@@ -38,14 +98,9 @@ if tool == "Analyze Website":
     if st.button("Run Analysis") and url and question:
         with st.spinner("Calling Analyze Website tool..."):
             try:
-                raw_output = call_tool_sync("analyze_website", {"url": url, "question": question})
-                # st.markdown("### Raw Output:")
-                # st.write(raw_output)
-
-                with st.spinner("Processing output with Structured Tool..."):
-                    processed = call_tool_sync("structured_tool", {"input_data": raw_output})
-                    st.markdown("### Processed Output:")
-                    st.write(processed)
+                # Fused path: the tool answers and formats in a single LLM call
+                st.markdown("### Processed Output:")
+                st.write_stream(stream_tool("analyze_website_stream", {"url": url, "question": question, "structured": True}))
 
             except Exception as e:
                 st.error(f"Error: {e}")
@@ -56,14 +111,9 @@ elif tool == "Ask YouTube Question":
     if st.button("Run Analysis") and video_url_or_query and question:
         with st.spinner("Calling Ask YouTube Question tool..."):
             try:
-                raw_output = call_tool_sync("ask_youtube_question", {"video_url_or_query": video_url_or_query, "question": question})
-                # st.markdown("### Raw Output:")
-                # st.write(raw_output)
-
-                with st.spinner("Processing output with Structured Tool..."):
-                    processed = call_tool_sync("structured_tool", {"input_data": raw_output})
-                    st.markdown("### Processed Output:")
-                    st.write(processed)
+                # Fused path: the tool answers and formats in a single LLM call
+                st.markdown("### Processed Output:")
+                st.write_stream(stream_tool("ask_youtube_question_stream", {"video_url_or_query": video_url_or_query, "question": question, "structured": True}))
             except Exception as e:
                 st.error(f"Error: {e}")
 
@@ -77,8 +127,7 @@ elif tool == "Analyze LinkedIn":
                 # st.write(raw_output)
 
                 with st.spinner("Processing output with Structured Tool..."):
-                    processed = call_tool_sync("structured_tool", {"input_data": raw_output})
                     st.markdown("### Processed Output:")
-                    st.write(processed)
+                    st.write_stream(stream_tool("structured_tool_stream", {"input_data": raw_output}))
             except Exception as e:
                 st.error(f"Error: {e}")